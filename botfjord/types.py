@@ -9,4 +9,4 @@ class Limit:
         self.time = time
         self.nodes = nodes
         if self.time is None and self.nodes is None:
-            nodes = 3200
+            self.nodes = 3200
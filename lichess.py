@@ -1,11 +1,14 @@
+import atexit
 import json
 import os
 import threading
 import time
+from collections import deque
 from pathlib import Path
 from timeit import default_timer as timer
 
 import berserk
+import berserk.exceptions
 import chess
 import chess.polyglot
 from dotenv import load_dotenv
@@ -13,9 +16,41 @@ from dotenv import load_dotenv
 from botfjord import mcts_rust
 from botfjord.types import Limit
 
+STANDARD_VARIANTS = frozenset(("standard", "fromPosition"))
+
+
+class RateLimiter:
+    def __init__(self, calls: int, period: float):
+        """
+        Sliding window rate limit that only waits once the window is full.\n
+        Args:
+            calls: calls allowed per period as int
+            period: seconds as float
+        """
+        self.period = period
+        self._calls = deque(maxlen=calls)
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Reserve a slot for a call, waiting until it opens if the window is full"""
+        with self._lock:
+            now = timer()
+            slot = now
+            if len(self._calls) == self._calls.maxlen:
+                slot = max(now, self._calls[0] + self.period)
+            self._calls.append(slot)
+        # Sleep outside the lock so other callers can reserve the following slots
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def _to_seconds(t) -> float:
+    """Converts a clock value parsed by berserk to seconds"""
+    return (t.hour * 60 + t.minute) * 60 + t.second + t.microsecond * 1e-6
+
 
 class Game(threading.Thread):
-    def __init__(self, client: berserk.Client, game_id: str):
+    def __init__(self, client: berserk.Client, game_id: str, bot_id: str, ongoing: dict):
         self._is_running = True
         super().__init__()
 
@@ -24,21 +59,32 @@ class Game(threading.Thread):
         self.stream = self.client.bots.stream_game_state(game_id)
 
         self.board = None
-        self.get_game_state()
+        self._rust_board = None  # Mirror of self.board for the engine, avoids FEN parsing
+        # Moves string already pushed to self.board, tracked by length to avoid rescanning it
+        self._moves_len = 0
+        self._last_move = ""
+        self._ply = 0
+        self._game_over = False  # Only changes when a move is pushed
+        self.refresh(ongoing)
 
         self._is_searching = False
         self._opp_timer = timer()
         self.limit = Limit(time=1)
 
-        self.name = client.account.get()["id"]
+        self.name = bot_id
         self._chat_active = True
-        self.white = self.name if self.color == "white" else self.opponent["username"]
+        self.white = self.name if self._is_white else self.opponent["username"]
         self.black = self.name if self.color == "black" else self.opponent["username"]
         print(f"Game {self.game_id} | Initialized | {self.white} v {self.black}")
 
     def run(self):
-        while self._is_running:
+        # Stopping on any exit, including errors, lets auto_check restart the game
+        try:
+            # The stream blocks until lichess sends an event and ends with the game
             for event in self.stream:
+                if not self._is_running:
+                    break
+
                 if event["type"] == "gameFull":
                     self.initial_fen = (
                         event["initialFen"]
@@ -46,62 +92,112 @@ class Game(threading.Thread):
                         else chess.STARTING_FEN
                     )
                     self.board = chess.Board(self.initial_fen)
+                    self._rust_board = mcts_rust.Board.from_fen(self.initial_fen)
+                    self._moves_len = 0
+                    self._last_move = ""
+                    self._ply = 0
+                    self._game_over = self.board.is_game_over()
                     event = event["state"]
-                    self.get_game_state()
 
                 if event["type"] == "gameState":
                     self.set_time(event)
                     self._is_searching = True
-                    move_list = event["moves"].split()
-                    if (self.color == "white") ^ len(move_list) % 2 == 0:
+                    self.push_moves(event["moves"])
+                    if self._is_white ^ self._ply % 2 == 0:
                         continue
-                    else:
-                        self.board = chess.Board(self.initial_fen)
-                        for uci_move in move_list:
-                            self.board.push_uci(uci_move)
                     self._is_searching = False
 
                 if event["type"] == "chatLine":
                     self.handle_chat()
 
                 self.check_turn()
+        finally:
+            if self._is_running:
+                self.stop()
+
+    def push_moves(self, moves: str):
+        """Bring the board up to date with the game's moves, only splitting and pushing new ones"""
+        played = self._moves_len
+        # A takeback shortens the moves or changes the last one we pushed
+        diverged = played and (
+            len(moves) < played
+            or moves[played : played + 1] not in ("", " ")
+            or not moves.endswith(self._last_move, 0, played)
+        )
+        if diverged:
+            # History diverged, so replay the game from the start
+            self.board = chess.Board(self.initial_fen)
+            self._rust_board = mcts_rust.Board.from_fen(self.initial_fen)
+            self._ply = 0
+            new_moves = moves.split()
+        else:
+            new_moves = moves[played:].split()
+        for uci_move in new_moves:
+            self.board.push_uci(uci_move)
+            self._rust_board.push_uci(uci_move)
+        self._moves_len = len(moves)
+        if new_moves:
+            self._last_move = new_moves[-1]
+            self._ply += len(new_moves)
+        self._game_over = self.board.is_game_over()
 
     def stop(self):
         print(f"Game {self.game_id} | Exited")
         self._is_running = False
-
-    def get_game_state(self, ongoing: list = None):
-        if ongoing is None:
-            ongoing = self.client.games.get_ongoing(count=10)
-        for game in ongoing:
-            if game["gameId"] == self.game_id:
-                self.game = game
-                self.fen = self.game["fen"]
-                self.color = self.game["color"]
-                self.op_color = "white" if self.color == "black" else "black"
-                self.opponent = self.game["opponent"]
-                self.is_my_turn = self.game["isMyTurn"]
-                self.last_move = self.game["lastMove"]
-                return
-        self.stop()  # Exit if none
+        mcts_rust.end_game(self.game_id)  # Stop pondering and free the search trees
+
+    def refresh(self, ongoing: dict):
+        """Update from ongoing games keyed by game id, fetched once and shared by all games"""
+        game = ongoing.get(self.game_id)
+        if game is None:
+            self.stop()  # Exit if none
+            return
+
+        self.game = game
+        self.fen = self.game["fen"]
+        self.color = self.game["color"]
+        self._is_white = self.color == "white"
+        self.op_color = "white" if self.color == "black" else "black"
+        self.opponent = self.game["opponent"]
+        self.is_my_turn = self.game["isMyTurn"]
+        self.last_move = self.game["lastMove"]
 
     def update_game_state(self):
-        self.is_my_turn = (self.color == "white") == (len(self.board.move_stack) % 2 == 0)
+        self.is_my_turn = self._is_white == (len(self.board.move_stack) % 2 == 0)
 
     def check_turn(self):
         """Check if currently our turn and make a move if it is"""
         self.update_game_state()
-        if self.is_my_turn and not self._is_searching and not self.board.is_game_over():
+        if self.is_my_turn and not self._is_searching and not self._game_over:
             self._is_searching = True
             self.calculate_limit()
-            next_move = get_move(self.board, self.limit)
-            try:
-                client.bots.make_move(game_id=self.game_id, move=next_move)
-                self.board.push_uci(next_move)
-                self._opp_timer = timer()
-            except:
-                self._is_searching = False
-                return
+            next_move = get_move(self.game_id, self.board, self._rust_board, self.limit)
+            move_limiter.acquire()
+            for attempt in range(2):
+                try:
+                    client.bots.make_move(game_id=self.game_id, move=next_move)
+                    break
+                except berserk.exceptions.ApiError as e:
+                    # Retry once when rate limited rather than waiting for the next event
+                    # Connection failures are plain ApiErrors without a status code
+                    if getattr(e, "status_code", None) == 429 and attempt == 0:
+                        time.sleep(0.2)
+                        continue
+                    print(f"Game {self.game_id} | Move failed | {e}")
+                    self._is_searching = False
+                    return
+            self.board.push_uci(next_move)
+            self._rust_board.push_uci(next_move)
+            self._moves_len += len(next_move) + (1 if self._moves_len else 0)
+            self._last_move = next_move
+            self._ply += 1
+            self._game_over = self.board.is_game_over()
+            self._opp_timer = timer()
+            # Keep searching on the opponent's time, the next search reuses the trees
+            if self._is_running and not self._game_over:
+                mcts_rust.start_ponder(
+                    self.game_id, self._rust_board, self.limit.time * 2, temperature, processes
+                )
             self.update_game_state()
             self._is_searching = False
 
@@ -111,42 +207,34 @@ class Game(threading.Thread):
                 game_id=self.game_id, text="Sorry, I'm not set up for chat yet!"
             )
             self._chat_active = False
-        self.get_game_state()
 
     def set_time(self, event):
         """Updates time and increment values"""
         try:
-            self.wtime = (
-                event["wtime"].second
-                + (event["wtime"].hour * 3600)
-                + (event["wtime"].minute * 60)
-                + (event["wtime"].microsecond / 1000000)
-            )
-            self.btime = (
-                event["btime"].second
-                + (event["btime"].hour * 3600)
-                + (event["btime"].minute * 60)
-                + (event["btime"].microsecond / 1000000)
-            )
-            self.winc = event["winc"].second + event["winc"].minute * 60
-            self.binc = event["binc"].second + event["binc"].minute * 60
+            self.wtime = _to_seconds(event["wtime"])
+            self.btime = _to_seconds(event["btime"])
+            self.winc = _to_seconds(event["winc"])
+            self.binc = _to_seconds(event["binc"])
         except AttributeError:
-            self.wtime = event["wtime"] / 1000
-            self.btime = event["btime"] / 1000
-            self.winc = event["winc"] / 1000
-            self.binc = event["binc"] / 1000
+            # Plain milliseconds
+            self.wtime = event["wtime"] * 1e-3
+            self.btime = event["btime"] * 1e-3
+            self.winc = event["winc"] * 1e-3
+            self.binc = event["binc"] * 1e-3
 
     def calculate_limit(self):
         """Calculate and set time limit based on remaining time and increment"""
         opp_time = timer() - self._opp_timer
-        rem_time = self.wtime if self.color == "white" else self.btime
+        is_white = self._is_white
+        fullmove = self.board.fullmove_number
+
+        rem_time = self.wtime if is_white else self.btime
         rem_time -= self.limit.time  # Account for search time by subtracting previous time
 
-        inc = self.winc if self.color == "white" else self.binc
-        inc *= 0.9
+        inc = (self.winc if is_white else self.binc) * 0.9
 
-        rem_moves_50 = 50 - self.board.fullmove_number  # 50 move avg game length
-        rem_moves_100 = 100 - self.board.fullmove_number  # 100 move long game length
+        rem_moves_50 = 50 - fullmove  # 50 move avg game length
+        rem_moves_100 = 100 - fullmove  # 100 move long game length
         if rem_moves_50 > 0:
             limit = (((rem_time * 0.5) / rem_moves_50) * 0.75) + (
                 ((rem_time * 0.9) / rem_moves_100) * 0.25
@@ -162,55 +250,105 @@ class Game(threading.Thread):
         limit += inc
         # Average with opponent's last time to avoid long turns against human players
         avg_limit = (limit + opp_time) / 2
-        limit = min(limit, rem_time, avg_limit, 10)
-        limit = max(limit - 0.4, 0.01)
+        limit = max(min(limit, rem_time, avg_limit, 10.0) - 0.4, 0.01)
         self.limit = Limit(time=limit)
 
 
-def get_move(game_state: chess.Board, limit: Limit) -> str:
+def get_move(
+    game_id: str, game_state: chess.Board, rust_board: mcts_rust.Board, limit: Limit
+) -> str:
     """Handles getting move from search or opening book"""
-    if _book:
-        with chess.polyglot.open_reader(os.environ["OPENING_BOOK_PATH"]) as reader:
-            try:
-                move = reader.weighted_choice(game_state).move.uci()
-                time.sleep(0.1)
-                return move
-            except IndexError:
-                ...
+    if _book_reader is not None:
+        try:
+            with _book_lock:
+                return _book_reader.weighted_choice(game_state).move.uci()
+        except IndexError:
+            ...
+
+    return mcts_rust.search_tree_board(game_id, rust_board, limit.time, temperature, processes)
+
+
+def _start_game(game_id: str, ongoing: dict = None, reason: str = "Start"):
+    """Start a game unless it is already running, shared by the event loop and auto_check"""
+    # Reserve the id before any API call so the other thread can't start it too
+    with games_lock:
+        if game_id in game_ids:
+            return
+        game_ids.add(game_id)
+    try:
+        if ongoing is None:
+            ongoing = get_ongoing()
+        game = Game(client=client, game_id=game_id, bot_id=bot_id, ongoing=ongoing)
+    except BaseException:
+        with games_lock:
+            game_ids.discard(game_id)
+        raise
+    with games_lock:
+        games.append(game)
+    print(f"Game {game.game_id} | {reason}")
+    game.start()
+    time.sleep(0.1)
 
-    return mcts_rust.search_tree(game_state.fen(), limit.time, temperature, processes)
 
+def _find_game(game_id: str):
+    with games_lock:
+        return next((game for game in games if game.game_id == game_id), None)
+
+
+def _remove_game(game: Game):
+    with games_lock:
+        if game in games:
+            games.remove(game)
+            game_ids.discard(game.game_id)
+
+
+def get_ongoing() -> dict:
+    """Ongoing games keyed by game id"""
+    return {game_info["gameId"]: game_info for game_info in client.games.get_ongoing(count=10)}
 
-def auto_check():
-    """Automatic timer to check game status preventing stuck games"""
-    ongoing = client.games.get_ongoing(count=10)
 
-    for game_info in ongoing:
-        if game_info["gameId"] not in [game.game_id for game in games]:
-            game = Game(client=client, game_id=game_info["gameId"])
-            print(f"Game {game.game_id} | Force Start")
-            games.append(game)
-            game.start()
-            time.sleep(0.1)
+def _auto_check_once():
+    """Check game status, starting missed games and dropping finished ones"""
+    ongoing = get_ongoing()
 
-    for game in games:
-        game.get_game_state(ongoing)
+    for game_id in ongoing:
+        _start_game(game_id, ongoing, reason="Force Start")
 
-    t = threading.Timer(5, auto_check)
-    t.start()
+    with games_lock:
+        current = list(games)
+    for game in current:
+        game.refresh(ongoing)
+
+    # Drop games that were stopped so they no longer count towards max_games
+    for game in current:
+        if not game._is_running:
+            _remove_game(game)
+
+
+# The event stream drives game start and finish, this poll only recovers missed events
+AUTO_CHECK_INTERVAL = 60
+
+
+def auto_check():
+    """Fallback check preventing stuck games, runs for the lifetime of the process"""
+    while True:
+        try:
+            _auto_check_once()
+        except Exception as e:
+            # Any error would otherwise kill the thread and silently stop the checks
+            print(f"Auto check failed | {e!r}")
+        time.sleep(AUTO_CHECK_INTERVAL)
 
 
 def should_accept(event):
     """Returns bool for if game should be accepted based on configured parameters"""
-    if (
-        (event["challenger"]["id"].lower() in accept_players or accept_players == [])
-        and (event["speed"] in accept_timecontrol or accept_timecontrol == [])
-        and event["variant"]["key"] in ["standard", "fromPosition"]
-        and len(games) <= max_games
-    ):
-        return True
-    else:
-        return False
+    # Cheapest and most commonly failing checks first
+    return (
+        len(game_ids) <= max_games
+        and event["variant"]["key"] in STANDARD_VARIANTS
+        and (not accept_timecontrol or event["speed"] in accept_timecontrol)
+        and (not accept_players or event["challenger"]["id"].lower() in accept_players)
+    )
 
 
 if __name__ == "__main__":
@@ -218,38 +356,46 @@ if __name__ == "__main__":
 
     processes = int(os.environ["SEARCH_PROCESSES"])
     temperature = float(os.environ["SEARCH_TEMPERATURE"])
-    accept_players = json.loads(os.environ["ACCEPT_PLAYERS"])
-    accept_timecontrol = json.loads(os.environ["ACCEPT_TIMECONTROL"])
+    accept_players = set(json.loads(os.environ["ACCEPT_PLAYERS"]))
+    accept_timecontrol = set(json.loads(os.environ["ACCEPT_TIMECONTROL"]))
     max_games = int(os.environ["MAX_GAMES"])
-
-    _book = True
-    if not Path(os.environ["OPENING_BOOK_PATH"]).exists():
+    move_limiter = RateLimiter(calls=100, period=60)
+    atexit.register(mcts_rust.shutdown)  # Stop any ponder still running on the workers
+
+    # Opened once and shared by all games, the lock guards concurrent lookups
+    _book_reader = None
+    _book_lock = threading.Lock()
+    if Path(os.environ["OPENING_BOOK_PATH"]).exists():
+        _book_reader = chess.polyglot.open_reader(os.environ["OPENING_BOOK_PATH"])
+        atexit.register(_book_reader.close)
+    else:
         print("Invalid opening book path | Opening book disabled")
-        _book = False
 
     session = berserk.TokenSession(os.environ["LICHESS_TOKEN"])
     client = berserk.Client(session)
+    bot_id = client.account.get()["id"]
 
     games: list[Game] = []
+    game_ids: set[str] = set()  # Ids of games that are running or being started
+    games_lock = threading.Lock()  # Guards games and game_ids across the two threads
+
+    threading.Thread(target=auto_check, daemon=True).start()
 
     for event in client.bots.stream_incoming_events():
-        if event["type"] == "challenge":
-            if should_accept(event["challenge"]):
-                try:
+        # A failed request only affects this event, the stream must keep running
+        try:
+            if event["type"] == "challenge":
+                if should_accept(event["challenge"]):
                     client.bots.accept_challenge(event["challenge"]["id"])
-                except:
-                    continue
-            else:
-                try:
+                else:
                     client.bots.decline_challenge(event["challenge"]["id"])
-                except:
-                    continue
-        elif event["type"] == "gameStart":
-            if event["game"]["id"] not in [game.game_id for game in games]:
-                game = Game(client=client, game_id=event["game"]["id"])
-                print(f"Game {game.game_id} | Start")
-                games.append(game)
-                game.start()
-                time.sleep(0.1)
-
-    auto_check()
+            elif event["type"] == "gameStart":
+                _start_game(event["game"]["id"])
+            elif event["type"] == "gameFinish":
+                # Free the slot as soon as lichess reports the end instead of waiting for a poll
+                game = _find_game(event["game"]["id"])
+                if game is not None:
+                    game.stop()
+                    _remove_game(game)
+        except berserk.exceptions.ApiError as e:
+            print(f"Event {event['type']} failed | {e}")
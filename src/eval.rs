@@ -1,9 +1,26 @@
-use chess::{BitBoard, Board, BoardStatus, ChessMove, Color, MoveGen, Piece, Square};
-use ordered_float::OrderedFloat;
-use std::collections::HashMap;
+use chess::{BitBoard, Board, BoardStatus, ChessMove, Color, MoveGen, Piece, Square, EMPTY};
+
+// Piece values indexed by `Piece::to_index()`, avoids hashing in the hot path
+const PIECE_VALUES: [f32; 6] = [1.0, 3.05, 3.33, 5.63, 9.5, 0.0];
+
+// Material balance from white's perspective
+#[inline]
+fn material(state: &Board) -> f32 {
+    let white = state.color_combined(Color::White);
+    // Black's count is the remainder, so white - black = 2 * white - total
+    let net = |piece: Piece| {
+        let pieces = state.pieces(piece);
+        (2 * (white & pieces).popcnt() as i32 - pieces.popcnt() as i32) as f32
+            * PIECE_VALUES[piece.to_index()]
+    };
+    net(Piece::Pawn)
+        + net(Piece::Knight)
+        + net(Piece::Bishop)
+        + net(Piece::Rook)
+        + net(Piece::Queen)
+}
 
 pub struct Evaluator {
-    piece_value_map: HashMap<Piece, f32>,
     outer_ring: Vec<Square>,
     mid_ring: Vec<Square>,
     inner_ring: Vec<Square>,
@@ -12,14 +29,7 @@ pub struct Evaluator {
 
 impl Evaluator {
     pub fn new() -> Evaluator {
-        let mut pvm = HashMap::new();
-        pvm.insert(Piece::Pawn, 1.0);
-        pvm.insert(Piece::Bishop, 3.33);
-        pvm.insert(Piece::Knight, 3.05);
-        pvm.insert(Piece::Rook, 5.63);
-        pvm.insert(Piece::Queen, 9.5);
         Evaluator {
-            piece_value_map: pvm,
             outer_ring: BitBoard::new(18411139144890810879).collect(),
             mid_ring: BitBoard::new(35538699412471296).collect(),
             inner_ring: BitBoard::new(66125924401152).collect(),
@@ -27,30 +37,18 @@ impl Evaluator {
         }
     }
 
-    pub fn evaluate(&self, state: Board) -> f32 {
-        if state.status() == BoardStatus::Checkmate {
-            return -39.0;
+    pub fn evaluate(&self, state: Board, moves: &[ChessMove]) -> f32 {
+        // `status()` would generate the legal moves again
+        if moves.is_empty() {
+            if state.checkers().popcnt() != 0 {
+                return -39.0;
+            }
+            return 0.0;
         }
 
-        let mut value = 0.0;
         let black = state.color_combined(Color::Black);
         let white = state.color_combined(Color::White);
-        let pawns = state.pieces(Piece::Pawn);
-        let bishops = state.pieces(Piece::Bishop);
-        let knights = state.pieces(Piece::Knight);
-        let rooks = state.pieces(Piece::Rook);
-        let queens = state.pieces(Piece::Queen);
-
-        value -= (black & pawns).popcnt() as f32 * self.piece_value_map[&Piece::Pawn];
-        value -= (black & bishops).popcnt() as f32 * self.piece_value_map[&Piece::Bishop];
-        value -= (black & knights).popcnt() as f32 * self.piece_value_map[&Piece::Knight];
-        value -= (black & rooks).popcnt() as f32 * self.piece_value_map[&Piece::Rook];
-        value -= (black & queens).popcnt() as f32 * self.piece_value_map[&Piece::Queen];
-        value += (white & pawns).popcnt() as f32 * self.piece_value_map[&Piece::Pawn];
-        value += (white & bishops).popcnt() as f32 * self.piece_value_map[&Piece::Bishop];
-        value += (white & knights).popcnt() as f32 * self.piece_value_map[&Piece::Knight];
-        value += (white & rooks).popcnt() as f32 * self.piece_value_map[&Piece::Rook];
-        value += (white & queens).popcnt() as f32 * self.piece_value_map[&Piece::Queen];
+        let mut value = material(&state);
 
         // Value for pushing king to outside in endgame
         if black.popcnt() <= 4 {
@@ -83,16 +81,12 @@ impl Evaluator {
         }
 
         // Remove value for pinned pieces
-        let pinned: Vec<_> = state.pinned().collect();
-        for square in pinned {
-            let piece = state.piece_on(square).unwrap();
-            if piece != Piece::King {
-                value -= self.piece_value_map[&piece]
-            }
+        for square in *state.pinned() {
+            value -= PIECE_VALUES[state.piece_on(square).unwrap().to_index()]
         }
 
         // Value for center control
-        for action in MoveGen::new_legal(&state) {
+        for action in moves {
             if self.center.contains(&action.get_dest()) {
                 value += 0.25
             }
@@ -108,12 +102,8 @@ impl Evaluator {
                     value -= 0.25
                 }
             }
-            let pinned: Vec<_> = state.pinned().collect();
-            for square in pinned {
-                let piece = state.piece_on(square).unwrap();
-                if piece != Piece::King {
-                    value += self.piece_value_map[&piece]
-                }
+            for square in *state.pinned() {
+                value += PIECE_VALUES[state.piece_on(square).unwrap().to_index()]
             }
         } else {
             // Value loss for each checker
@@ -123,46 +113,60 @@ impl Evaluator {
         value
     }
 
-    pub fn priors(&self, state: Board) -> HashMap<ChessMove, f32> {
-        let mut priors = HashMap::new();
-
-        let score = |state: Board| {
-            if state.status() == BoardStatus::Checkmate {
-                return -16.0;
-            }
-            let piece_diff = state.color_combined(Color::White).popcnt() as f32
-                - state.color_combined(Color::Black).popcnt() as f32;
-            match state.side_to_move() {
-                Color::White => piece_diff,
-                Color::Black => -piece_diff,
-            }
-        };
-
-        for action in MoveGen::new_legal(&state) {
+    // Returns prior values in the same order as `moves`
+    pub fn priors(&self, state: Board, moves: &[ChessMove]) -> Vec<f32> {
+        let mut priors = Vec::with_capacity(moves.len());
+
+        // Piece difference from the perspective of the side making the move
+        // Only captures change it, so it is computed once and updated per move
+        let us = state.color_combined(state.side_to_move()).popcnt() as f32;
+        let them = state.color_combined(!state.side_to_move()).popcnt() as f32;
+        let piece_diff = us - them;
+        let occupied = *state.combined();
+        let pawns = *state.pieces(Piece::Pawn);
+
+        for &action in moves {
+            let src = BitBoard::from_square(action.get_source());
+            let dst = BitBoard::from_square(action.get_dest());
+            let is_capture = occupied & dst != EMPTY
+                || (pawns & src != EMPTY
+                    && action.get_source().get_file() != action.get_dest().get_file());
+
+            // Mate is only possible if the move gives check
             let new_state = state.make_move_new(action);
-            assert_ne!(new_state, state);
-            priors.insert(action, score(new_state) + 0.0000001);
+            let score = if new_state.checkers().popcnt() != 0
+                && new_state.status() == BoardStatus::Checkmate
+            {
+                -16.0
+            } else if is_capture {
+                -(piece_diff + 1.0)
+            } else {
+                -piece_diff
+            };
+            priors.push(score + 0.0000001);
         }
 
         if priors.is_empty() {
             return priors;
         }
 
-        let abs_min = priors
-            .values()
-            .min_by_key(|v| OrderedFloat(**v))
-            .unwrap()
-            .abs();
-        let max = (priors.values().max_by_key(|v| OrderedFloat(**v)).unwrap() + abs_min) * 1.25;
-        let mut new_priors = HashMap::new();
-        for (action, value) in priors.iter() {
-            new_priors.insert(*action, max - (value + abs_min));
+        // Find both extremes in one pass, then shift and normalize in place
+        let (min, max) = priors
+            .iter()
+            .fold((f32::INFINITY, f32::NEG_INFINITY), |(lo, hi), &v| {
+                (lo.min(v), hi.max(v))
+            });
+        let abs_min = min.abs();
+        let max = (max + abs_min) * 1.25;
+        let mut sum = 0.0;
+        for value in priors.iter_mut() {
+            *value = max - (*value + abs_min);
+            sum += *value;
         }
 
-        let sum: f32 = new_priors.values().sum();
         let norm_factor = 1.0 / (sum + 0.0000001);
-        for (action, value) in new_priors.iter() {
-            priors.insert(*action, value * norm_factor);
+        for value in priors.iter_mut() {
+            *value *= norm_factor;
         }
 
         priors
@@ -3,115 +3,342 @@ use crate::{
     eval::Evaluator,
     mcts::{Limit, Tree},
 };
-use chess::{Board, ChessMove, MoveGen};
+use chess::{Board, ChessMove, MoveGen, Piece, Square};
 use ordered_float::OrderedFloat;
-use pyo3::prelude::*;
+use pyo3::{exceptions::PyValueError, prelude::*};
 use std::{
     collections::HashMap,
     str::FromStr,
-    sync::{mpsc, Arc, Mutex},
+    sync::{
+        atomic::{AtomicBool, Ordering},
+        mpsc, Arc, Mutex,
+    },
     thread,
-    time::Instant,
+    time::{Duration, Instant},
 };
 
 mod eval;
 mod mcts;
 
+// Transposition table entries kept for each game, split between the workers searching it
+const TABLE_BUDGET: usize = 1 << 17;
+
+// Search request handled by a single worker thread
+struct Job {
+    game_id: String,
+    board: Board,
+    // Absolute, so time spent queued behind other games' jobs counts against the budget
+    deadline: Instant,
+    temperature: f32,
+    table_capacity: usize,
+    results: mpsc::Sender<Vec<f32>>,
+    stop: Option<Arc<AtomicBool>>,
+}
+
+enum Message {
+    Search(Job),
+    // Drops the tree kept for a finished game
+    EndGame(String),
+}
+
+// Long-lived search threads, each owning one tree per game that is kept between searches
+static WORKERS: Mutex<Vec<mpsc::Sender<Message>>> = Mutex::new(Vec::new());
+// Stop flags of the background searches queued by `start_ponder`, by game id
+static PONDERS: Mutex<Vec<(String, Arc<AtomicBool>)>> = Mutex::new(Vec::new());
+
+fn spawn_worker() -> mpsc::Sender<Message> {
+    let (tx, rx) = mpsc::channel::<Message>();
+    thread::spawn(move || {
+        let mut trees: HashMap<String, Tree> = HashMap::new();
+        for message in rx {
+            match message {
+                Message::Search(job) => {
+                    // Skip ponders that were stopped while still queued
+                    if job
+                        .stop
+                        .as_ref()
+                        .map_or(false, |stop| stop.load(Ordering::Relaxed))
+                    {
+                        continue;
+                    }
+                    let tree = trees
+                        .entry(job.game_id)
+                        .or_insert_with(|| Tree::new(Evaluator::new(), 0.0, 0.3));
+                    tree.set_temperature(job.temperature);
+                    tree.set_table_capacity(job.table_capacity);
+                    let remaining = job.deadline.saturating_duration_since(Instant::now());
+                    // A zero time limit means unlimited, so an expired job still stops
+                    // after its first iteration
+                    let limit = Limit::new(Some(remaining.as_secs_f32().max(0.001)), Some(0.0));
+                    // Receiver is only gone if the caller stopped waiting
+                    let _ = job
+                        .results
+                        .send(tree.search(job.board, limit, job.stop.as_deref()));
+                }
+                Message::EndGame(game_id) => {
+                    trees.remove(&game_id);
+                }
+            }
+        }
+    });
+    tx
+}
+
+const SQUARE_NAMES: [&str; 64] = [
+    "a1", "b1", "c1", "d1", "e1", "f1", "g1", "h1", "a2", "b2", "c2", "d2", "e2", "f2", "g2", "h2",
+    "a3", "b3", "c3", "d3", "e3", "f3", "g3", "h3", "a4", "b4", "c4", "d4", "e4", "f4", "g4", "h4",
+    "a5", "b5", "c5", "d5", "e5", "f5", "g5", "h5", "a6", "b6", "c6", "d6", "e6", "f6", "g6", "h6",
+    "a7", "b7", "c7", "d7", "e7", "f7", "g7", "h7", "a8", "b8", "c8", "d8", "e8", "f8", "g8", "h8",
+];
+
 fn uci(action: &ChessMove) -> String {
-    let squares = vec![
-        "A1", "B1", "C1", "D1", "E1", "F1", "G1", "H1", "A2", "B2", "C2", "D2", "E2", "F2", "G2",
-        "H2", "A3", "B3", "C3", "D3", "E3", "F3", "G3", "H3", "A4", "B4", "C4", "D4", "E4", "F4",
-        "G4", "H4", "A5", "B5", "C5", "D5", "E5", "F5", "G5", "H5", "A6", "B6", "C6", "D6", "E6",
-        "F6", "G6", "H6", "A7", "B7", "C7", "D7", "E7", "F7", "G7", "H7", "A8", "B8", "C8", "D8",
-        "E8", "F8", "G8", "H8",
-    ];
     let src = action.get_source().to_index();
     let dst = action.get_dest().to_index();
-    format!(
-        "{}{}",
-        squares[src].to_lowercase(),
-        squares[dst].to_lowercase()
-    )
+    let promotion = match action.get_promotion() {
+        Some(Piece::Queen) => "q",
+        Some(Piece::Rook) => "r",
+        Some(Piece::Bishop) => "b",
+        Some(Piece::Knight) => "n",
+        _ => "",
+    };
+    format!("{}{}{}", SQUARE_NAMES[src], SQUARE_NAMES[dst], promotion)
 }
 
-#[pyfunction]
-fn search_tree(fen: String, time: f32, temperature: f32, processes: usize) -> String {
-    let start = Instant::now();
+// Splits a UCI move into its squares and promotion piece, None if malformed
+fn parse_uci(uci_move: &str) -> Option<(Square, Square, Option<Piece>)> {
+    let src = Square::from_str(uci_move.get(0..2)?).ok()?;
+    let dst = Square::from_str(uci_move.get(2..4)?).ok()?;
+    let promotion = match uci_move.get(4..)? {
+        "" => None,
+        "q" => Some(Piece::Queen),
+        "r" => Some(Piece::Rook),
+        "b" => Some(Piece::Bishop),
+        "n" => Some(Piece::Knight),
+        _ => return None,
+    };
+    Some((src, dst, promotion))
+}
 
-    let mut handles = vec![];
-    let mut move_dict = HashMap::new();
+// Board kept by the caller and updated move by move, so searches skip FEN parsing
+#[pyclass(name = "Board")]
+struct PyBoard {
+    board: Board,
+}
 
-    for action in MoveGen::new_legal(&Board::from_str(&fen).unwrap()) {
-        move_dict.insert(action, 0);
+#[pymethods]
+impl PyBoard {
+    #[staticmethod]
+    fn from_fen(fen: &str) -> PyResult<PyBoard> {
+        match Board::from_str(fen) {
+            Ok(board) => Ok(PyBoard { board }),
+            Err(_) => Err(PyValueError::new_err(format!("Invalid FEN: {}", fen))),
+        }
     }
 
-    let fen_mtx = Arc::new(Mutex::new(fen));
-    let time_mtx = Arc::new(Mutex::new(time));
-    let temperature_mtx = Arc::new(Mutex::new(temperature));
-
-    let (tx, rx) = mpsc::channel();
-    let tx_mtx = Arc::new(Mutex::new(tx));
-
-    for _ in 0..processes {
-        let t_fen = Arc::clone(&fen_mtx);
-        let t_time = Arc::clone(&time_mtx);
-        let t_temperature = Arc::clone(&temperature_mtx);
-        let t_tx = Arc::clone(&tx_mtx);
+    fn push_uci(&mut self, uci_move: &str) -> PyResult<()> {
+        let action = parse_uci(uci_move).and_then(|(src, dst, promotion)| {
+            MoveGen::new_legal(&self.board).find(|action| {
+                action.get_source() == src
+                    && action.get_dest() == dst
+                    && action.get_promotion() == promotion
+            })
+        });
+        match action {
+            Some(action) => {
+                self.board = self.board.make_move_new(action);
+                Ok(())
+            }
+            None => Err(PyValueError::new_err(format!("Illegal move: {}", uci_move))),
+        }
+    }
+}
 
-        let handle = thread::spawn(move || {
-            let board = Board::from_str(&t_fen.lock().unwrap()).unwrap();
+#[pyfunction]
+fn search_tree(
+    py: Python,
+    game_id: String,
+    fen: String,
+    time: f32,
+    temperature: f32,
+    processes: usize,
+) -> String {
+    let board = Board::from_str(&fen).unwrap();
+    search(py, game_id, board, time, temperature, processes)
+}
 
-            let evaluator = Evaluator::new();
-            let mut tree = Tree::new(evaluator, *t_temperature.lock().unwrap(), 0.3);
-            let limit = Limit::new(Some(*t_time.lock().unwrap()), Some(0.0));
+#[pyfunction]
+fn search_tree_board(
+    py: Python,
+    game_id: String,
+    board: PyRef<PyBoard>,
+    time: f32,
+    temperature: f32,
+    processes: usize,
+) -> String {
+    let state = board.board;
+    // Release the borrow before the GIL is released during the search
+    drop(board);
+    search(py, game_id, state, time, temperature, processes)
+}
 
-            let results = tree.search(board, limit);
-            for result in results {
-                t_tx.lock().unwrap().send(result).unwrap();
-            }
+// Queues the same search on the first `processes` workers
+fn dispatch(
+    game_id: &str,
+    board: Board,
+    deadline: Instant,
+    temperature: f32,
+    processes: usize,
+    results: mpsc::Sender<Vec<f32>>,
+    stop: Option<Arc<AtomicBool>>,
+) {
+    let mut workers = WORKERS.lock().unwrap();
+    while workers.len() < processes {
+        workers.push(spawn_worker());
+    }
+    let table_capacity = TABLE_BUDGET / processes.max(1);
+    for worker in workers.iter_mut().take(processes) {
+        let job = Message::Search(Job {
+            game_id: game_id.to_string(),
+            board,
+            deadline,
+            temperature,
+            table_capacity,
+            results: results.clone(),
+            stop: stop.clone(),
         });
-        handles.push(handle);
+        // Replace the worker if its thread has died
+        if let Err(mpsc::SendError(job)) = worker.send(job) {
+            *worker = spawn_worker();
+            worker.send(job).unwrap();
+        }
     }
+}
 
-    drop(tx_mtx);
-    for (action, visits) in rx {
-        *move_dict.get_mut(&action).unwrap() += visits as usize;
+// Ends the background searches of games matching `filter`
+fn stop_ponders(filter: impl Fn(&str) -> bool) {
+    PONDERS.lock().unwrap().retain(|(game_id, stop)| {
+        if filter(game_id) {
+            stop.store(true, Ordering::Relaxed);
+            return false;
+        }
+        true
+    });
+}
+
+// Keeps the workers searching `board` for up to `time` seconds while the opponent thinks.
+// The game's trees are kept, so its next search reuses them once the opponent's move is played.
+// Replaces the game's previous ponder, and any game's search stops it.
+#[pyfunction]
+fn start_ponder(
+    game_id: String,
+    board: PyRef<PyBoard>,
+    time: f32,
+    temperature: f32,
+    processes: usize,
+) {
+    stop_ponders(|id| id == game_id);
+    if MoveGen::new_legal(&board.board).len() == 0 {
+        return;
     }
+    let deadline = Instant::now() + Duration::from_secs_f32(time);
+    let stop = Arc::new(AtomicBool::new(false));
+    // Nothing waits for the visit counts, workers ignore the closed channel
+    let (tx, _) = mpsc::channel();
+    dispatch(
+        &game_id,
+        board.board,
+        deadline,
+        temperature,
+        processes,
+        tx,
+        Some(Arc::clone(&stop)),
+    );
+    PONDERS.lock().unwrap().push((game_id, stop));
+}
 
-    let mut results = vec![];
-    for item in move_dict.iter() {
-        results.push(item);
+// Stops the game's ponder and frees its trees on every worker
+#[pyfunction]
+fn end_game(game_id: String) {
+    stop_ponders(|id| id == game_id);
+    for worker in WORKERS.lock().unwrap().iter() {
+        // A dead worker holds no trees
+        let _ = worker.send(Message::EndGame(game_id.clone()));
     }
+}
+
+fn search(
+    py: Python,
+    game_id: String,
+    board: Board,
+    time: f32,
+    temperature: f32,
+    processes: usize,
+) -> String {
+    // Workers run one job at a time, so any game's ponder would delay this move.
+    // Stopped ponders still leave their tree for that game's next search.
+    stop_ponders(|_| true);
+    let start = Instant::now();
+    let deadline = start + Duration::from_secs_f32(time);
 
-    for handle in handles {
-        handle.join().unwrap();
+    // Workers report visit counts in this same move order
+    let moves: Vec<ChessMove> = MoveGen::new_legal(&board).collect();
+    if moves.len() == 1 {
+        return uci(&moves[0]);
     }
+    let mut visits = vec![0.0; moves.len()];
 
-    results.sort_by_key(|x| x.1);
-    results.reverse();
-    let mut fmt_results = vec![];
-    let mut nodes = 0;
-    for (i, (action, value)) in results.iter().enumerate() {
-        nodes += **value;
-        if i < 5 {
-            fmt_results.push(format!("{} {:.0}", uci(action), value));
+    let (tx, rx) = mpsc::channel();
+    dispatch(&game_id, board, deadline, temperature, processes, tx, None);
+
+    // Release the GIL so other games can run while the workers search
+    py.allow_threads(|| {
+        for results in rx {
+            for (total, count) in visits.iter_mut().zip(results) {
+                *total += count;
+            }
         }
+    });
+
+    // Only the 5 most visited moves are reported, so avoid sorting the rest
+    let by_visits = |a: &usize, b: &usize| OrderedFloat(visits[*b]).cmp(&OrderedFloat(visits[*a]));
+    let mut order: Vec<usize> = (0..moves.len()).collect();
+    if order.len() > 5 {
+        order.select_nth_unstable_by(5, by_visits);
+        order.truncate(5);
+    }
+    order.sort_by(by_visits);
+    let mut fmt_results = vec![];
+    for &i in order.iter() {
+        fmt_results.push(format!("{} {:.0}", uci(&moves[i]), visits[i]));
     }
+    let nodes: f32 = visits.iter().sum();
     let run_time = start.elapsed().as_secs_f32();
     println!(
         "{} | {:.0} nodes/s ({:.2}s | {:.0} nodes)",
         fmt_results.join(" | "),
-        nodes as f32 / run_time,
+        nodes / run_time,
         run_time,
         nodes
     );
 
-    uci(&results[0].0)
+    uci(&moves[order[0]])
+}
+
+// Stops the worker threads once their queued searches finish
+#[pyfunction]
+fn shutdown() {
+    stop_ponders(|_| true);
+    WORKERS.lock().unwrap().clear();
 }
 
 #[pymodule]
 #[allow(unused_variables)]
 fn mcts_rust(py: Python, m: &PyModule) -> PyResult<()> {
+    m.add_class::<PyBoard>()?;
     m.add_function(wrap_pyfunction!(search_tree, m)?)?;
+    m.add_function(wrap_pyfunction!(search_tree_board, m)?)?;
+    m.add_function(wrap_pyfunction!(start_ponder, m)?)?;
+    m.add_function(wrap_pyfunction!(end_game, m)?)?;
+    m.add_function(wrap_pyfunction!(shutdown, m)?)?;
     Ok(())
 }
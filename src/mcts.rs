@@ -1,4 +1,4 @@
-use chess::{Board, BoardStatus, ChessMove, MoveGen};
+use chess::{Board, ChessMove, MoveGen};
 use ordered_float::OrderedFloat;
 use rand::{prelude::*, thread_rng};
 use rand_distr::Dirichlet;
@@ -7,31 +7,40 @@ use std::{
     collections::HashMap,
     fmt::{Debug, Formatter, Result},
     option::Option,
-    rc::{Rc, Weak},
+    rc::Rc,
+    sync::atomic::{AtomicBool, Ordering},
     time::Instant,
 };
 
 use crate::eval::Evaluator;
 
-struct Branch {
-    prior: f32,
-    visit_count: f32,
-    total_value: f32,
-}
+// Default number of positions the transposition table holds before it is cleared
+const TABLE_CAPACITY: usize = 1 << 16;
 
 pub struct Limit {
     time: f32,
     nodes: f32,
 }
 
+// Branch statistics are stored as parallel arrays indexed by position in `moves`
+// Boxed slices since the branch count is fixed once the node is created,
+// the move list is shared with the transposition table entry
 struct Node {
     state: Board,
     value: f32,
-    parent: Option<Weak<RefCell<Node>>>,
-    last_move: Option<Rc<ChessMove>>,
     total_visit_count: f32,
-    branches: HashMap<ChessMove, Branch>,
-    children: HashMap<Rc<ChessMove>, Rc<RefCell<Node>>>,
+    moves: Rc<[ChessMove]>,
+    priors: Box<[f32]>,
+    visit_counts: Box<[f32]>,
+    total_values: Box<[f32]>,
+    children: Box<[Option<Rc<RefCell<Node>>>]>,
+}
+
+// Evaluator output for a position, before Dirichlet noise is applied
+struct TableEntry {
+    value: f32,
+    moves: Rc<[ChessMove]>,
+    priors: Box<[f32]>,
 }
 
 pub struct Tree {
@@ -39,16 +48,10 @@ pub struct Tree {
     c: f32,
     noise: f32,
     rng: ThreadRng,
-}
-
-impl Branch {
-    fn new(prior: f32) -> Branch {
-        Branch {
-            prior,
-            visit_count: 0.0,
-            total_value: 0.0,
-        }
-    }
+    table: HashMap<u64, TableEntry>,
+    table_capacity: usize,
+    // Root of the previous search, kept so its subtree can be reused
+    root: Option<Rc<RefCell<Node>>>,
 }
 
 impl Limit {
@@ -56,7 +59,7 @@ impl Limit {
         if time.is_none() && nodes.is_none() {
             return Limit {
                 time: 0.0,
-                nodes: 0.0,
+                nodes: 3200.0,
             };
         }
         Limit {
@@ -72,100 +75,107 @@ impl Debug for Node {
             .field("state", &self.state)
             .field("value", &self.value)
             .field("visits", &self.total_visit_count)
-            .field("last_move", &self.last_move)
-            .field("parent", &self.parent)
+            .field("moves", &self.moves)
             .finish()
     }
 }
 
 impl Node {
-    fn new(
-        state: Board,
-        value: f32,
-        priors: HashMap<ChessMove, f32>,
-        parent: Option<Weak<RefCell<Node>>>,
-        last_move: Option<Rc<ChessMove>>,
-    ) -> Node {
-        let children = HashMap::new();
-        let mut branches = HashMap::new();
-        for action in MoveGen::new_legal(&state) {
-            // Unwrap is not recommended but we don't want an error to pass silently
-            let prior = priors.get(&action).unwrap();
-            branches.insert(action, Branch::new(*prior));
-        }
+    fn new(state: Board, value: f32, moves: Rc<[ChessMove]>, priors: Vec<f32>) -> Node {
+        let move_count = moves.len();
         Node {
             state,
             value,
-            parent,
-            last_move,
             total_visit_count: 1.0,
-            branches,
-            children,
+            moves,
+            priors: priors.into_boxed_slice(),
+            visit_counts: vec![0.0; move_count].into_boxed_slice(),
+            total_values: vec![0.0; move_count].into_boxed_slice(),
+            children: vec![None; move_count].into_boxed_slice(),
         }
     }
 
-    fn moves(&self) -> Vec<&ChessMove> {
-        self.branches.keys().collect()
+    fn moves(&self) -> &[ChessMove] {
+        &self.moves
     }
 
-    fn add_child(&mut self, action: Rc<ChessMove>, child_node: Rc<RefCell<Node>>) {
+    fn add_child(&mut self, action: usize, child_node: Rc<RefCell<Node>>) {
         // Add error handling for existing keys
         // Currently will silently overwrite value but it should not be allowed
-        self.children.insert(action, child_node);
+        self.children[action] = Some(child_node);
     }
 
-    fn has_child(&self, action: &ChessMove) -> bool {
-        self.children.contains_key(action)
+    fn has_child(&self, action: usize) -> bool {
+        self.children[action].is_some()
     }
 
-    fn get_child(&self, action: &ChessMove) -> &Rc<RefCell<Node>> {
-        self.children.get(action).unwrap()
+    fn get_child(&self, action: usize) -> &Rc<RefCell<Node>> {
+        self.children[action].as_ref().unwrap()
     }
 
-    fn expected_value(&self, action: &ChessMove) -> f32 {
-        let branch = self.branches.get(action).unwrap();
-        if branch.visit_count == 0.0 {
+    fn expected_value(&self, action: usize) -> f32 {
+        let visit_count = self.visit_counts[action];
+        if visit_count == 0.0 {
             return 0.0;
         }
-        branch.total_value / branch.visit_count
+        self.total_values[action] / visit_count
     }
 
-    fn prior(&self, action: &ChessMove) -> f32 {
-        self.branches.get(action).unwrap().prior
+    fn prior(&self, action: usize) -> f32 {
+        self.priors[action]
     }
 
-    fn visit_count(&self, action: &ChessMove) -> f32 {
-        match self.branches.get(action) {
-            Some(b) => b.visit_count,
-            None => 0.0,
-        }
+    fn visit_count(&self, action: usize) -> f32 {
+        self.visit_counts[action]
     }
 
-    fn record_visit(&mut self, action: &ChessMove, value: f32) {
-        let branch = self.branches.get_mut(action).unwrap();
-        branch.visit_count += 1.0;
-        branch.total_value += value;
+    fn record_visit(&mut self, action: usize, value: f32) {
+        self.visit_counts[action] += 1.0;
+        self.total_values[action] += value;
         self.total_visit_count += 1.0;
     }
 
     fn check_visit_counts(&self, rounds: f32) -> bool {
-        let mut branches: Vec<_> = self.branches.values().collect();
-        branches.sort_by(|a, b| OrderedFloat(b.visit_count).cmp(&OrderedFloat(a.visit_count)));
+        // Single pass for the two highest visit counts
+        let (mut first, mut second) = (-1.0, -1.0);
+        for &visit_count in self.visit_counts.iter() {
+            if visit_count >= first {
+                second = first;
+                first = visit_count;
+            } else if visit_count > second {
+                second = visit_count;
+            }
+        }
         let remaining_rounds = rounds - self.total_visit_count;
-        branches[0].visit_count >= branches[1].visit_count + remaining_rounds
+        first >= second + remaining_rounds
     }
 
     fn check_visit_ratio(&self, factor: f32, minimum: f32) -> bool {
         if self.total_visit_count < minimum {
             return false;
         }
-        let branches: Vec<_> = self.branches.values().collect();
-        let branch = branches
+        let visit_count = self
+            .visit_counts
             .iter()
-            .max_by_key(|b| OrderedFloat(b.visit_count))
+            .max_by_key(|v| OrderedFloat(**v))
             .unwrap();
-        branch.visit_count > self.total_visit_count * factor
+        *visit_count > self.total_visit_count * factor
+    }
+}
+
+// Depth-first search for the node holding `state` at most `depth` plies below `node`
+fn find_node(node: &Rc<RefCell<Node>>, state: Board, depth: usize) -> Option<Rc<RefCell<Node>>> {
+    if node.borrow().state == state {
+        return Some(Rc::clone(node));
     }
+    if depth == 0 {
+        return None;
+    }
+    node.borrow()
+        .children
+        .iter()
+        .flatten()
+        .find_map(|child| find_node(child, state, depth - 1))
 }
 
 impl Tree {
@@ -175,110 +185,148 @@ impl Tree {
             c: temperature,
             noise,
             rng: thread_rng(),
+            table: HashMap::new(),
+            table_capacity: TABLE_CAPACITY,
+            root: None,
         }
     }
 
-    fn create_node(
-        &mut self,
-        state: Board,
-        action: Option<Rc<ChessMove>>,
-        parent: Option<Weak<RefCell<Node>>>,
-    ) -> Node {
-        let mut priors = self.evaluator.priors(state);
-        let value = self.evaluator.evaluate(state);
+    pub fn set_temperature(&mut self, temperature: f32) {
+        self.c = temperature;
+    }
+
+    pub fn set_table_capacity(&mut self, capacity: usize) {
+        self.table_capacity = capacity;
+        if self.table.len() > capacity {
+            self.table = HashMap::new();
+        }
+    }
+
+    // Detaches the subtree for `state` from the previous search if it was explored
+    // Looks two plies deep to cover our move followed by the opponent's reply
+    fn reuse_root(&mut self, state: Board) -> Option<Rc<RefCell<Node>>> {
+        let previous = self.root.take()?;
+        find_node(&previous, state, 2)
+    }
+
+    fn create_node(&mut self, state: Board) -> Node {
+        // Positions reached by a different move order reuse the cached evaluation
+        let hash = state.get_hash();
+        // Moves are shared with the table, priors are copied since noise is applied to them
+        let (value, moves, mut priors) = match self.table.get(&hash) {
+            Some(entry) => (entry.value, Rc::clone(&entry.moves), entry.priors.to_vec()),
+            None => {
+                // Generate legal moves once and share them with the evaluator and node
+                let moves: Vec<ChessMove> = MoveGen::new_legal(&state).collect();
+                let value = self.evaluator.evaluate(state, &moves);
+                let priors = self.evaluator.priors(state, &moves);
+                let moves: Rc<[ChessMove]> = moves.into();
+                if self.table.len() >= self.table_capacity {
+                    self.table.clear();
+                }
+                let entry = TableEntry {
+                    value,
+                    moves: Rc::clone(&moves),
+                    priors: priors.as_slice().into(),
+                };
+                self.table.insert(hash, entry);
+                (value, moves, priors)
+            }
+        };
 
         // Add Dirichlet noise
         if self.noise != 0.0 {
-            let move_count = MoveGen::new_legal(&state).len();
+            let move_count = moves.len();
             if move_count > 1 {
                 let dirichlet = Dirichlet::new_with_size(self.noise, move_count).unwrap();
                 let samples = dirichlet.sample(&mut self.rng);
-                let mut new_priors: HashMap<ChessMove, f32> = HashMap::new();
-                for ((action, value), noise) in priors.iter().zip(samples) {
-                    new_priors.insert(*action, (value * 0.5) + (noise * 0.5));
+                for (value, noise) in priors.iter_mut().zip(samples) {
+                    *value = (*value * 0.5) + (noise * 0.5);
                 }
-                priors = new_priors;
             }
         }
 
-        Node::new(state, value, priors, parent, action)
+        Node::new(state, value, moves, priors)
     }
 
-    fn select_branch(&self, node: &Node) -> ChessMove {
-        let total_n = node.total_visit_count;
+    fn select_branch(&self, node: &Node) -> usize {
+        // sqrt(ln(N) / n) = sqrt(ln(N)) / sqrt(n), the first factor is shared by all branches
+        let factor = self.c * node.total_visit_count.ln().sqrt();
 
-        let score_branch = |action: &ChessMove| {
+        let score_branch = |action: usize| {
             let q = node.expected_value(action);
             let p = node.prior(action);
             let n = node.visit_count(action);
-            q + self.c * p * (total_n.ln() / (n + 0.0000001)).sqrt()
+            q + factor * p / (n + 0.0000001).sqrt()
         };
 
         // Sometimes panicking!
-        match node
-            .moves()
-            .iter()
-            .max_by_key(|m| OrderedFloat(score_branch(m)))
-        {
-            Some(m) => **m,
+        match (0..node.moves().len()).max_by_key(|&i| OrderedFloat(score_branch(i))) {
+            Some(i) => i,
             None => {
                 println!("Error: {:?}", node.moves());
-                return *node.moves()[0];
+                return 0;
             }
         }
     }
 
-    pub fn search(&mut self, state: Board, limit: Limit) -> Vec<(ChessMove, f32)> {
+    // Returns root visit counts in `MoveGen::new_legal` order for `state`
+    // `stop` lets another thread end the search early, e.g. to preempt pondering
+    pub fn search(&mut self, state: Board, limit: Limit, stop: Option<&AtomicBool>) -> Vec<f32> {
+        let mut i = 0.0;
+        let mut iteration: usize = 0;
+        let start_time = Instant::now();
+        let root = match self.reuse_root(state) {
+            Some(node) => node,
+            None => Rc::new(RefCell::new(self.create_node(state))),
+        };
+        self.root = Some(Rc::clone(&root));
+
         // Return early if only 1 legal move available
-        if MoveGen::new_legal(&state).len() == 1 {
-            // This looks silly
-            return vec![(MoveGen::new_legal(&state).next().unwrap(), 1.0)];
+        if root.borrow().moves().len() == 1 {
+            return vec![1.0];
         }
 
-        let mut i = 0.0;
-        let start_time = Instant::now();
-        let root = Rc::new(RefCell::new(self.create_node(state, None, None)));
         loop {
+            // Selection is kept as the path of (node, branch) pairs from the root
+            let mut path = vec![];
             let mut node = Rc::clone(&root);
-            let mut next_move = Rc::new(self.select_branch(&node.borrow()));
+            let mut next_move = self.select_branch(&node.borrow());
 
-            while node.borrow().has_child(&next_move) {
-                let new_node = Rc::clone(node.borrow().get_child(&next_move));
+            while node.borrow().has_child(next_move) {
+                let new_node = Rc::clone(node.borrow().get_child(next_move));
+                path.push((node, next_move));
                 node = new_node;
-                next_move = Rc::new(self.select_branch(&node.borrow()));
+                next_move = self.select_branch(&node.borrow());
             }
 
-            let new_state = node.borrow().state.make_move_new(*next_move);
-            let child_node = Rc::new(RefCell::new(self.create_node(
-                new_state,
-                Some(Rc::clone(&next_move)),
-                Some(Rc::downgrade(&node)),
-            )));
-            if new_state.status() == BoardStatus::Ongoing {
+            let action = node.borrow().moves()[next_move];
+            let new_state = node.borrow().state.make_move_new(action);
+            let child_node = Rc::new(RefCell::new(self.create_node(new_state)));
+            // The child's legal moves are already generated, so use them instead
+            // of `status()` to tell whether the game continues from it
+            if !child_node.borrow().moves().is_empty() {
                 node.borrow_mut()
-                    .add_child(Rc::clone(&next_move), Rc::clone(&child_node));
+                    .add_child(next_move, Rc::clone(&child_node));
             }
+            path.push((node, next_move));
 
-            let mut action = Rc::clone(&next_move);
             let mut value = -child_node.borrow().value;
-            loop {
-                node.borrow_mut().record_visit(&action, value);
-                action = Rc::clone(match node.borrow().last_move.as_ref() {
-                    Some(m) => m,
-                    None => break,
-                });
-                let new_node =
-                    Rc::clone(&node.borrow().parent.as_ref().unwrap().upgrade().unwrap());
-                node = new_node;
+            for (node, action) in path.iter().rev() {
+                node.borrow_mut().record_visit(*action, value);
                 value = -value;
             }
 
-            if root.borrow().check_visit_ratio(0.90, 50000.0) {
+            // Both root checks scan every branch, so only run them periodically
+            iteration += 1;
+            let check_root = iteration & 31 == 0;
+            if check_root && root.borrow().check_visit_ratio(0.90, 50000.0) {
                 break;
             }
 
             if limit.nodes > 0.0 {
-                if i >= limit.nodes || root.borrow().check_visit_counts(limit.nodes) {
+                if i >= limit.nodes || (check_root && root.borrow().check_visit_counts(limit.nodes))
+                {
                     break;
                 } else {
                     i += 1.0;
@@ -289,12 +337,14 @@ impl Tree {
                     break;
                 }
             }
+            if let Some(stop) = stop {
+                if stop.load(Ordering::Relaxed) {
+                    break;
+                }
+            }
         }
 
-        let mut results = vec![];
-        for action in root.borrow().moves() {
-            results.push((*action, root.borrow().visit_count(action)));
-        }
+        let results = root.borrow().visit_counts.to_vec();
         results
     }
 }